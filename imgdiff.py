@@ -4,10 +4,28 @@ import os
 import stat
 import sys
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import shutil
 import subprocess
 import hashlib
+import itertools
+import mmap
+import sqlite3
 import tempfile
 import tarfile
+import threading
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 class Image(object):
     def __init__(self, image=None, root=None, files=None, tmp_dir=None):
@@ -17,38 +35,389 @@ class Image(object):
         self.files = files
         self.tmp_dir = tmp_dir
         
-def sha256sum(filename,block_size=65536, retry=True): # Default block_size is 64k
-    sha256 = hashlib.sha256()
+class DigestCache(object):
+    """Digests persisted across runs in an sqlite database in cache_dir.
+
+    An entry is only used while the file's inode, size, mtime and ctime are
+    unchanged. ctime is checked as well as mtime because build tools commonly
+    clamp mtimes (e.g. to SOURCE_DATE_EPOCH), so a rebuilt file can keep both
+    its size and mtime while its contents change.
+
+    New digests are held in memory and written in one short transaction by
+    close(), so runs sharing cache_dir don't lock each other out. If the
+    database fails later on, a warning goes to error_handle and the run
+    carries on without the cache.
+    """
+    def __init__(self, cache_dir, error_handle=sys.stderr, timeout=30):
+        super(DigestCache, self).__init__()
+        self.error_handle = error_handle
+        self.pending = []
+        self.failed = False
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'digests.sqlite'), timeout=timeout, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT, algo TEXT, ino INTEGER, size INTEGER, '
+                            'mtime_ns INTEGER, ctime_ns INTEGER, digest TEXT, PRIMARY KEY (path, algo))')
+            self.db.commit()
+
+    def fail(self, e):
+        # Called with self.lock held
+        if not self.failed:
+            self.failed = True
+            self.error_handle.write("Digest cache error, continuing without it: %s\n" % e)
+
+    def get(self, filename, st, algo):
+        with self.lock:
+            if self.failed:
+                return None
+            try:
+                row = self.db.execute('SELECT digest FROM digests WHERE path = ? AND algo = ? AND ino = ? AND size = ? '
+                                      'AND mtime_ns = ? AND ctime_ns = ?', (os.path.abspath(filename), algo, st.st_ino,
+                                      st.st_size, st.st_mtime_ns, st.st_ctime_ns)).fetchone()
+            except sqlite3.Error as e:
+                self.fail(e)
+                return None
+        return row[0] if row else None
+
+    def put(self, filename, st, algo, digest):
+        # Written out in one go by close()
+        with self.lock:
+            self.pending.append((os.path.abspath(filename), algo, st.st_ino, st.st_size, st.st_mtime_ns,
+                                 st.st_ctime_ns, digest))
+
+    def close(self):
+        with self.lock:
+            try:
+                if self.pending and not self.failed:
+                    with self.db: # Commits, or rolls back on error
+                        self.db.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+            except sqlite3.Error as e:
+                self.fail(e)
+            finally:
+                self.pending = []
+                self.db.close()
+
+# A file found in an image: its directory relative to the image root, its
+# name, its full path, whether it is a symlink, its size, its link count and
+# its (st_dev, st_ino). Files read straight from a tar stream have no path or
+# inode, but carry the digest of their contents, or the target of the link for
+# symlinks, instead.
+FileEntry = collections.namedtuple('FileEntry', ['dir', 'name', 'path', 'is_symlink', 'size', 'nlink', 'inode', 'digest', 'link'],
+                                   defaults=(None, None, None))
+
+def fadvise(fd, *advice):
+    # Pass access pattern hints (e.g. 'SEQUENTIAL' for POSIX_FADV_SEQUENTIAL)
+    # for the whole of file fd to the kernel, where posix_fadvise is available
+    if hasattr(os, 'posix_fadvise'):
+        for name in advice:
+            os.posix_fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_' + name))
+
+# Files up to this size are read in one go, as the per-file overhead of
+# hinting the kernel and reading in blocks outweighs the actual work for them
+SMALL_FILE_SIZE = 16384
+
+# Digests already computed, keyed on (st_dev, st_ino, st_size, st_mtime_ns) so
+# hardlinked or otherwise repeated files are only read once. st_dev keeps the
+# entries for the two images apart.
+_hash_cache = {}
+
+def cache_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def prefetch(filename):
+    # Have the kernel start reading filename into the page cache in the
+    # background
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return # Only a hint, file_digest deals with unreadable files
     try:
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(block_size)
-                if not data:
-                    break
-                sha256.update(data)
+        fadvise(fd, 'WILLNEED')
+    finally:
+        os.close(fd)
+
+def new_digest(algo='blake2b'):
+    if algo == 'blake3':
+        return blake3.blake3()
+    if algo == 'xxh3':
+        return xxhash.xxh3_128()
+    return hashlib.new(algo)
+
+def stream_digest(f, algo='blake2b', block_size=65536): # Default block_size is 64k
+    new = lambda: new_digest(algo)
+    try:
+        # Python 3.11+ runs the whole read/update loop in C
+        digest = hashlib.file_digest(f, new)
+    except AttributeError:
+        digest = new()
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest
+
+def cached_digest(filename, algo='blake2b', db=None):
+    # Return the stat of filename and its digest, or None if it isn't known yet
+    st = os.stat(filename)
+    key = cache_key(st)
+    if key in _hash_cache:
+        return st, _hash_cache[key]
+    if db:
+        digest = db.get(filename, st, algo)
+        if digest:
+            _hash_cache[key] = digest
+            return st, digest
+    return st, None
+
+def file_digest(filename, algo='blake2b', db=None, st=None, block_size=65536, mmap_threshold=65536, retry=True): # Default block_size is 64k
+    # st is passed in when cached_digest has already missed for filename
+    if st is None:
+        st, digest = cached_digest(filename, algo, db)
+        if digest:
+            return digest
+    key = cache_key(st)
+    try:
+        if st.st_size <= SMALL_FILE_SIZE:
+            # One read and one update, without the readahead hints or the
+            # 256k buffer hashlib.file_digest allocates on every call
+            with open(filename, 'rb', buffering=0) as f:
+                data = f.read()
+            digest = new_digest(algo)
+            digest.update(data)
+        elif algo == 'blake3':
+            # blake3 hashes a single file on several threads
+            digest = blake3.blake3(max_threads=blake3.blake3.AUTO).update_mmap(filename)
+        else:
+            with open(filename, 'rb', buffering=0) as f:
+                fadvise(f.fileno(), 'SEQUENTIAL', 'WILLNEED')
+                if st.st_size > mmap_threshold:
+                    # Hash straight from the page cache rather than copying it
+                    # out with read(). mmap refuses empty files, hence the threshold.
+                    digest = new_digest(algo)
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+                        digest.update(mm)
+                else:
+                    digest = stream_digest(f, algo, block_size)
+                # Don't let hashing a large tree push everything else out of the page cache
+                fadvise(f.fileno(), 'DONTNEED')
     except PermissionError:
         if retry:
             os.chmod(filename, os.stat(filename).st_mode | stat.S_IRUSR) # Add u+r permission
-            return sha256sum(filename, retry=False)
+            return file_digest(filename, algo, db, None, block_size, mmap_threshold, retry=False)
         else:
             raise PermissionError
-    return sha256.hexdigest()
+    _hash_cache[key] = digest.hexdigest()
+    if db:
+        db.put(filename, st, algo, _hash_cache[key])
+    return _hash_cache[key]
+
+def files_equal(file1, file2, size=None, block_size=1048576, retry=True): # Default block_size is 1M
+    # Compare the contents directly, stopping at the first block that differs
+    try:
+        with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+            if size is not None and size <= SMALL_FILE_SIZE:
+                return f1.read() == f2.read()
+            # No WILLNEED here, the files may well differ in their first block
+            fadvise(f1.fileno(), 'SEQUENTIAL')
+            fadvise(f2.fileno(), 'SEQUENTIAL')
+            try:
+                while True:
+                    data1 = f1.read(block_size)
+                    data2 = f2.read(block_size)
+                    if data1 != data2:
+                        return False
+                    if not data1:
+                        return True
+            finally:
+                fadvise(f1.fileno(), 'DONTNEED')
+                fadvise(f2.fileno(), 'DONTNEED')
+    except PermissionError:
+        if retry:
+            for filename in (file1, file2):
+                if not os.access(filename, os.R_OK):
+                    os.chmod(filename, os.stat(filename).st_mode | stat.S_IRUSR) # Add u+r permission
+            return files_equal(file1, file2, size, block_size, retry=False)
+        else:
+            raise PermissionError
+
+def link_target(entry):
+    return os.readlink(entry.path) if entry.path else entry.link
 
-def get_contents(top_dir, sorted=False):
+def entry_digest(entry, algo='blake2b', db=None):
+    return file_digest(entry.path, algo, db) if entry.path else entry.digest
+
+def compare_pair(entry1, entry2, algo='blake2b', db=None):
+    match = True
+    error = None
+    try:
+        # If either file is a symlink, check that the other is too and that they point to the same target
+        if entry1.is_symlink or entry2.is_symlink:
+            if not (entry1.is_symlink and entry2.is_symlink):
+                match = False
+            elif link_target(entry1) != link_target(entry2):
+                match = False
+        # Files of different sizes can't match, so don't bother hashing them
+        elif entry1.size != entry2.size:
+            match = False
+        # Empty files always match
+        elif not entry1.size:
+            pass
+        # So do two names for the same inode, e.g. when comparing a tree with
+        # a hard linked copy of it
+        elif entry1.inode and entry1.inode == entry2.inode:
+            pass
+        # Else if it's a non-empty normal file with other hard links, compare
+        # digests, so the shared inode is only read once however many names it
+        # has. With a persistent digest cache, always compare digests, so
+        # unchanged files aren't read at all on later runs. Files from a tar
+        # stream can only be compared by digest.
+        elif db or entry1.nlink > 1 or entry2.nlink > 1 or not (entry1.path and entry2.path):
+            if entry2.path:
+                st2, digest2 = cached_digest(entry2.path, algo, db)
+                if digest2 is None and entry1.path and entry2.size > SMALL_FILE_SIZE:
+                    # Read the second file ahead while the first one is hashed.
+                    # Not worth the extra syscalls for small files.
+                    prefetch(entry2.path)
+            digest1 = entry_digest(entry1, algo, db)
+            if not entry2.path:
+                digest2 = entry2.digest
+            elif digest2 is None:
+                digest2 = file_digest(entry2.path, algo, db, st2)
+            if digest1 != digest2:
+                match = False
+        # Else compare contents directly
+        elif not files_equal(entry1.path, entry2.path, entry1.size):
+            match = False
+    except PermissionError as e:
+        error = e
+    return match, error
+
+def get_contents(top_dir):
     top_dir = top_dir.rstrip('/')
     
-    file_dict = {}
-
-    for root, dirs, files in os.walk(top_dir):
-        if sorted:
-            dirs.sort() # Affects recursive traversal order
-            files.sort() # Affects file inspection order
-        for file in files:
-            path = os.path.relpath(root,top_dir)
-            if not path in file_dict:
-                file_dict[path] = {}
-            file_dict[path][file] = os.path.join(root, file)
-    return file_dict
+    files = []
+
+    # Walk the tree with os.scandir, keeping the type and size of each file
+    # from its DirEntry so they don't need to be looked up again when comparing
+    stack = [top_dir]
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        # Every root is top_dir or below it, so slice rather than call relpath
+        path = root[len(top_dir)+1:] or '.'
+        for entry in entries:
+            # Symlinks to directories are compared as symlinks, not followed
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            st = entry.stat(follow_symlinks=False)
+            files.append(FileEntry(path, entry.name, entry.path, entry.is_symlink(), st.st_size, st.st_nlink,
+                                   (st.st_dev, st.st_ino)))
+    # Sorted by directory, then name
+    files.sort()
+    return files
+
+def group_by_dir(files):
+    # Split a sorted list of FileEntry into (dir, [FileEntry, ...]) runs
+    return [(dir, list(entries)) for dir, entries in itertools.groupby(files, key=lambda entry: entry.dir)]
+
+def merge(list1, list2, key):
+    # Walk two lists sorted on key in step, yielding pairs of items with equal
+    # keys. An item with no counterpart in the other list is paired with None.
+    i = j = 0
+    while i < len(list1) or j < len(list2):
+        if j == len(list2) or (i < len(list1) and key(list1[i]) < key(list2[j])):
+            yield list1[i], None
+            i += 1
+        elif i == len(list1) or key(list1[i]) > key(list2[j]):
+            yield None, list2[j]
+            j += 1
+        else:
+            yield list1[i], list2[j]
+            i += 1
+            j += 1
+
+@contextlib.contextmanager
+def open_tar_stream(image, bzip2):
+    # Open image as a stream through the bzip2 decompressor given, or through
+    # tarfile's own decompression if bzip2 is None
+    if bzip2 is None:
+        with tarfile.open(image, mode='r|*') as tar:
+            yield tar
+        return
+    with subprocess.Popen([bzip2, '-dc', image], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+        # Drain the padding after the end of the archive, so bzip2 isn't
+        # killed by SIGPIPE
+        while proc.stdout.read(65536):
+            pass
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+def parallel_bzip2():
+    # bzip2 decompression dominates reading an image, so use a parallel bzip2
+    # if one is installed
+    for bzip2 in ('lbzip2', 'pbzip2'):
+        if shutil.which(bzip2):
+            return bzip2
+    return None
+
+def unpack_image(image, dest):
+    bzip2 = parallel_bzip2()
+    if bzip2:
+        with open_tar_stream(image, bzip2) as tar:
+            # Carry on past members that can't be created, like device nodes
+            # when not running as root, as tar itself does
+            tar.errorlevel = 0
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(dest, filter='tar')
+            else:
+                tar.extractall(dest)
+        return
+    # tar fails on members it can't create, like device nodes when not running
+    # as root, but still unpacks the rest, which is worth comparing
+    result = subprocess.run(['tar', '--atime-preserve', '-xjpsf', image, '-C', dest],
+        stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    if result.returncode and not os.listdir(dest):
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+
+def digest_tar(image, algo='blake2b'):
+    # Read the contents of a tar image straight from the stream, keeping a
+    # digest of each file instead of unpacking it to disk
+    entries = {}
+    digests = {}
+    with open_tar_stream(image, parallel_bzip2()) as tar:
+        for member in tar:
+            if member.isdir():
+                continue
+            name = os.path.normpath(member.name.lstrip('/'))
+            dir, file = os.path.split(name)
+            size = member.size
+            digest = None
+            if member.isreg():
+                if size:
+                    digest = stream_digest(tar.extractfile(member), algo).hexdigest()
+                digests[name] = (size, digest)
+            elif member.islnk():
+                # A hard link has no data of its own in the archive
+                size, digest = digests.get(os.path.normpath(member.linkname.lstrip('/')), (0, None))
+            # A later member of the same name replaces an earlier one, as it would when unpacking
+            entries[name] = FileEntry(dir or '.', file, None, member.issym(), size, 1, digest=digest,
+                                      link=member.linkname if member.issym() else None)
+    # Sorted by directory, then name
+    return sorted(entries.values())
 
 def main():
     parser = argparse.ArgumentParser(
@@ -62,8 +431,16 @@ def main():
             help='output file to use instead of stdout.')
     parser.add_argument('-s', '--stats',
             help='output statistics about diff', action='store_true')
+    hash_group = parser.add_mutually_exclusive_group()
+    hash_group.add_argument('--hash', choices=['sha256', 'blake2b', 'blake3', 'xxh3'],
+            help='hash algorithm used to fingerprint file contents (default: xxh3 if the xxhash package is installed, else blake2b).')
+    hash_group.add_argument('--strict-hash',
+            help='fingerprint file contents with SHA-256 rather than a faster hash (same as --hash=sha256).',
+            action='store_true')
+    parser.add_argument('--cache-dir',
+            help='keep file digests in this directory (e.g. ~/.cache/imgdiff) so files unchanged since a previous run are not read again. Only used for directory images, and not when an image has to be unpacked to a temporary directory (as with --diffoscope).')
     parser.add_argument('-r', '--sort',
-            help='traverse files in sorted order (easier for human inspection)', action='store_true')
+            help='traverse files in sorted order (always the case now, kept for compatibility)', action='store_true')
 
     args = parser.parse_args()
 
@@ -71,12 +448,22 @@ def main():
     error_handle = output_handle if args.output_file else sys.stderr
 
     if args.diffoscope:
-        try:
-            subprocess.run("diffoscope --version", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
-        except subprocess.SubprocessError:
+        if shutil.which('diffoscope') is None:
             error_handle.write("Please install diffoscope\n")
             sys.exit(1)
 
+    # Collisions aren't a concern when comparing build images, so unless asked
+    # otherwise, use the fastest hash available
+    if args.strict_hash:
+        args.hash = 'sha256'
+    elif args.hash is None:
+        args.hash = 'xxh3' if xxhash else 'blake2b'
+    if args.hash == 'blake3' and blake3 is None:
+        error_handle.write("Please install the blake3 python package\n")
+        sys.exit(1)
+    if args.hash == 'xxh3' and xxhash is None:
+        error_handle.write("Please install the xxhash python package\n")
+        sys.exit(1)
 
     image1 = Image(image=args.images[0])
     image2 = Image(image=args.images[1])
@@ -84,118 +471,155 @@ def main():
     # Set up the directories to compare
     if os.path.isdir(image1.image): # If image1 is an already unpacked dir
         image1.root = image1.image
-    elif tarfile.is_tarfile(image1.image): # If image1 is tar.bz2
+    elif tarfile.is_tarfile(image1.image) and not args.diffoscope: # If image1 is tar.bz2
+        # Read the image straight from the tar stream
+        try:
+            image1.files = digest_tar(image1.image, args.hash)
+        except (subprocess.SubprocessError, tarfile.TarError):
+            error_handle.write("Error reading image: %s" % image1.image)
+            sys.exit(1)
+    elif tarfile.is_tarfile(image1.image):
+        # diffoscope needs the files on disk, so unpack the image to a temporary directory
         image1.tmp_dir = tempfile.TemporaryDirectory()
         image1.root = image1.tmp_dir.name
-        # Unpack the images to temporary directory
         try:
-            subprocess.run('tar --atime-preserve -xjsf %s -C %s' % (image1.image, image1.root),
-                shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        except subprocess.SubprocessError:
+            unpack_image(image1.image, image1.root)
+        except (subprocess.SubprocessError, tarfile.TarError, OSError):
             error_handle.write("Error unpacking image: %s" % image1.image)
             sys.exit(1)
     # elif is ext4 partition, mount it    
     
     if os.path.isdir(image2.image): # If image2 is an already unpacked dir
         image2.root = image2.image
+    elif tarfile.is_tarfile(image2.image) and not args.diffoscope:
+        # Read the image straight from the tar stream
+        try:
+            image2.files = digest_tar(image2.image, args.hash)
+        except (subprocess.SubprocessError, tarfile.TarError):
+            error_handle.write("Error reading image: %s" % image2.image)
+            sys.exit(1)
     elif tarfile.is_tarfile(image2.image):
+        # diffoscope needs the files on disk, so unpack the image to a temporary directory
         image2.tmp_dir = tempfile.TemporaryDirectory()
         image2.root = image2.tmp_dir.name
-        # Unpack the images to temporary directory
         try:
-            subprocess.run('tar --atime-preserve -xjpsf %s -C %s' % (image2.image, image2.root),
-                shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        except subprocess.SubprocessError:
+            unpack_image(image2.image, image2.root)
+        except (subprocess.SubprocessError, tarfile.TarError, OSError):
             error_handle.write("Error unpacking image: %s" % image2.image)
             sys.exit(1)
     # elif is ext4 partition, mount it    
     
-    image1.files = get_contents(image1.root, args.sort)
-    image2.files = get_contents(image2.root, args.sort)
+    # Files unpacked to a temporary directory won't be seen again, so there's
+    # no point in persisting their digests. Tar images read as a stream have
+    # no files on disk at all.
+    db = None
+    if args.cache_dir and not (image1.tmp_dir or image2.tmp_dir) and (image1.root or image2.root):
+        # The cache only saves time, so don't let it stop the compare
+        try:
+            db = DigestCache(os.path.expanduser(args.cache_dir), error_handle)
+        except (OSError, sqlite3.Error) as e:
+            error_handle.write("Cannot use digest cache in %s, continuing without it: %s\n" % (args.cache_dir, e))
+
+    if image1.files is None:
+        image1.files = get_contents(image1.root)
+    if image2.files is None:
+        image2.files = get_contents(image2.root)
 
-    ret = 0;
     stats = {'match'        : 0,
              'missmatch'    : 0,
              'missing1'     : 0,
              'missing2'     : 0,
              'dir_missing1' : 0,
              'dir_missing2' : 0}
-    for dir in image1.files:
-        if dir in image2.files:
-            # Check all files in image1.files[dir] against files in image2.files[dir]
-            for file in image1.files[dir]:
-                if file in image2.files[dir]:
-                    match = True
-                    try:
-                        # If either file is a symlink, check that the other is too and that they point to the same target
-                        if os.path.islink(image1.files[dir][file]) or os.path.islink(image2.files[dir][file]):
-                            if not (os.path.islink(image1.files[dir][file]) and os.path.islink(image2.files[dir][file])):
-                                match = False
-                            elif os.readlink(image1.files[dir][file]) != os.readlink(image2.files[dir][file]):
-                                match = False
-                       # Else if it's a normal file, compare checksums
-                        elif sha256sum(image1.files[dir][file]) != sha256sum(image2.files[dir][file]):
-                            match = False
-                    except PermissionError:
-                        error_handle.write('Permission Error: cannot compare %s' % os.path.join(dir,file))
-
-                    # If the files matched
-                    if match:
-                        if args.stats:
-                            stats['match'] += 1
-                    else:
-                        output_handle.write("File Missmatch: '%s' from %s and %s\n" % (os.path.join(dir,file), image1.image, image2.image))
-                        if args.stats:
-                            stats['missmatch'] += 1
-                        ret = 1
-                        if args.diffoscope:
-                            output_handle.write("diffoscope output:\n")
-                            try:
-                                output_handle.write(subprocess.run('diffoscope %s %s' % (image1.files[dir][file],image2.files[dir][file]),
-                                    shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode('utf-8'))
-                            except subprocess.SubprocessError:
-                                error_handle.write('Call to diffoscope failed.\n')
-
-                    image2.files[dir].pop(file, None) # So we can check later if anything is left in image2.files[dir]
+
+    # Pair up the files of both images with a single merge over the sorted
+    # contents. Every file present in both images is compared up front on a
+    # thread pool, so the reads of different files overlap; the results are
+    # then reported in sorted order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
+        results = []
+        for dir1, dir2 in merge(group_by_dir(image1.files), group_by_dir(image2.files), key=lambda dir: dir[0]):
+            if dir1 is None or dir2 is None:
+                results.append((dir1, dir2, None))
+                continue
+            for entry1, entry2 in merge(dir1[1], dir2[1], key=lambda entry: entry.name):
+                future = executor.submit(compare_pair, entry1, entry2, args.hash, db) if entry1 and entry2 else None
+                results.append((entry1, entry2, future))
+
+    # Output is collected here and written in one go, except for the output
+    # of diffoscope, which can be large
+    out = []
+    emit = out.append
+    emit_error = emit if error_handle is output_handle else error_handle.write
+    def flush():
+        output_handle.write(''.join(out))
+        out.clear()
+
+    try:
+        for item1, item2, future in results:
+            if future:
+                match, error = future.result()
+                path = os.path.join(item1.dir, item1.name)
+                if error:
+                    emit_error('Permission Error: cannot compare %s' % path)
+
+                # If the files matched
+                if match:
+                    stats['match'] += 1
                 else:
-                    output_handle.write("Missing File: '%s' from %s not found in %s\n" % (os.path.join(dir,file), image1.image, image2.image))
-                    if args.stats:
-                        stats['missing1'] += 1
-                    ret = 1
-            # If there's anything left in image2.files[dir], it wasn't in image1.files[dir]
-            for file in image2.files[dir]:
-                output_handle.write("Missing File: '%s' from %s not found in %s\n" % (os.path.join(dir,file), image2.image, image1.image))
-                if args.stats:
-                    stats['missing2'] += 1
-                ret = 1
-            image2.files.pop(dir, None) # So we can check later if anything is left in image2.files
-        else:
-            output_handle.write("Missing Directory (with %i files): '%s' from %s not found in %s\n" % (len(image1.files[dir]), dir, image1.image, image2.image))
-            if args.stats:
-                stats['dir_missing1'] +=1
-                stats['missing1'] += len(image1.files[dir])
-            ret = 1
-    # if there is anything left in image2.files, it wasn't in image1.files
-    for dir in image2.files:
-        output_handle.write("Missing Directory (with %i files): '%s' from %s not found in %s\n" % (len(image2.files[dir]), dir, image2.image, image1.image))
-        if args.stats:
-            stats['dir_missing2'] += 1
-            stats['missing2'] += len(image2.files[dir])
-        ret = 1
+                    emit("File Missmatch: '%s' from %s and %s\n" % (path, image1.image, image2.image))
+                    stats['missmatch'] += 1
+                    if args.diffoscope:
+                        emit("diffoscope output:\n")
+                        flush()
+                        try:
+                            result = subprocess.run(['diffoscope', item1.path, item2.path],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                            # diffoscope exits with 1 when the files differ, which they do here
+                            if result.returncode > 1:
+                                raise subprocess.CalledProcessError(result.returncode, result.args)
+                            output_handle.write(result.stdout.decode('utf-8'))
+                        except subprocess.SubprocessError:
+                            emit_error('Call to diffoscope failed.\n')
+            elif isinstance(item1, FileEntry):
+                emit("Missing File: '%s' from %s not found in %s\n" % (os.path.join(item1.dir,item1.name), image1.image, image2.image))
+                stats['missing1'] += 1
+            elif isinstance(item2, FileEntry):
+                emit("Missing File: '%s' from %s not found in %s\n" % (os.path.join(item2.dir,item2.name), image2.image, image1.image))
+                stats['missing2'] += 1
+            elif item1:
+                dir, entries = item1
+                emit("Missing Directory (with %i files): '%s' from %s not found in %s\n" % (len(entries), dir, image1.image, image2.image))
+                stats['dir_missing1'] += 1
+                stats['missing1'] += len(entries)
+            else:
+                dir, entries = item2
+                emit("Missing Directory (with %i files): '%s' from %s not found in %s\n" % (len(entries), dir, image2.image, image1.image))
+                stats['dir_missing2'] += 1
+                stats['missing2'] += len(entries)
 
+        # The counts are kept whether or not --stats was given, which is cheaper
+        # than checking for it for every file
+        ret = 1 if stats['missmatch'] or stats['missing1'] or stats['missing2'] else 0
 
-    if args.stats:
-        file_total = stats['match'] + stats['missmatch'] + stats['missing1'] + stats['missing2']
-        missing_total = stats['missing1'] + stats['missing2']
-        output_handle.write('----------------------STATS----------------------\n')
-        output_handle.write('Total files compared: %i\n' % file_total)
-        output_handle.write('Matches: %i (%s)\n' % (stats['match'], '{:.2%}'.format(stats['match']/file_total)))
-        output_handle.write('Misses: %i (%s)\n' % (stats['missmatch'], '{:.2%}'.format(stats['missmatch']/file_total)))
-        output_handle.write('Missing: %i (%s)\n' % (missing_total, '{:.2%}'.format(missing_total/file_total)))
-        output_handle.write('Files from %s missing from %s: %i\n' % (image1.image,image2.image,stats['missing1']))
-        output_handle.write('Files from %s missing from %s: %i\n' % (image2.image,image1.image,stats['missing2']))
-        output_handle.write('Dirs from %s missing from %s: %i\n' % (image1.image,image2.image,stats['dir_missing1']))
-        output_handle.write('Dirs from %s missing from %s: %i\n' % (image2.image,image1.image,stats['dir_missing2']))
+        if args.stats:
+            file_total = stats['match'] + stats['missmatch'] + stats['missing1'] + stats['missing2']
+            missing_total = stats['missing1'] + stats['missing2']
+            emit('----------------------STATS----------------------\n')
+            emit('Total files compared: %i\n' % file_total)
+            emit('Matches: %i (%s)\n' % (stats['match'], '{:.2%}'.format(stats['match']/file_total)))
+            emit('Misses: %i (%s)\n' % (stats['missmatch'], '{:.2%}'.format(stats['missmatch']/file_total)))
+            emit('Missing: %i (%s)\n' % (missing_total, '{:.2%}'.format(missing_total/file_total)))
+            emit('Files from %s missing from %s: %i\n' % (image1.image,image2.image,stats['missing1']))
+            emit('Files from %s missing from %s: %i\n' % (image2.image,image1.image,stats['missing2']))
+            emit('Dirs from %s missing from %s: %i\n' % (image1.image,image2.image,stats['dir_missing1']))
+            emit('Dirs from %s missing from %s: %i\n' % (image2.image,image1.image,stats['dir_missing2']))
+    finally:
+        # Don't lose the report so far, or the digests to be cached, if a
+        # comparison raised
+        flush()
+        if db:
+            db.close()
 
     # Close output handle if file
     if output_handle is not sys.stdout: